@@ -0,0 +1,60 @@
+# coding: utf-8
+# Author: Axel ARONIO DE ROMBLAY <axelderomblay@gmail.com>
+# License: BSD 3 clause
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+
+except ImportError:
+    NUMBA_AVAILABLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """No-op decorator used when numba is not installed."""
+        if (len(args) == 1) and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(parallel=True)
+def _isin_int64(arr, values):
+    """Element-wise membership test of an int64 array in a (small) int64 array."""
+    out = np.empty(arr.shape[0], np.bool_)
+
+    for i in prange(arr.shape[0]):
+        found = False
+        for j in range(values.shape[0]):
+            if arr[i] == values[j]:
+                found = True
+                break
+        out[i] = found
+
+    return out
+
+
+def isin(serie, values):
+    """Tests whether each element of an integer pandas Serie is in values.
+
+    Uses a compiled kernel if numba is installed, pandas.Series.isin otherwise.
+
+    Parameters
+    ----------
+    serie : pandas Serie of shape = (n, )
+        The values to test, with an integer dtype.
+
+    values : list-like
+        The integer values to look for.
+
+    Returns
+    -------
+    numpy array of shape = (n, )
+        The boolean mask.
+    """
+    if NUMBA_AVAILABLE:
+        return _isin_int64(serie.values.astype(np.int64, copy=False),
+                           np.asarray(list(values), dtype=np.int64))
+    else:
+        return serie.isin(values).values
@@ -3,15 +3,24 @@
 # License: BSD 3 clause
 
 import numpy as np
-import pandas as pd
 import warnings
 import time
+import os
+import json
+import itertools
+import joblib
+import tensorflow as tf
 
 from hyperopt import fmin, hp, tpe
 from sklearn.model_selection import cross_val_score, KFold, StratifiedKFold
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
 from sklearn.metrics import SCORERS, make_scorer, roc_auc_score
+from sklearn.exceptions import NotFittedError
+from sklearn.preprocessing import LabelBinarizer
+from lightgbm.basic import LightGBMError
 
+from .. import _accel
 from ..encoding.na_encoder import NA_encoder
 from ..encoding.categorical_encoder import Categorical_encoder
 from ..model.classification.feature_selector import Clf_feature_selector
@@ -22,6 +31,17 @@ from ..model.classification.classifier import Classifier
 from ..model.regression.regressor import Regressor
 
 
+# Pipeline components of each task, indexed by the kind of the target dtype :
+# estimator, feature selector, stacking layer, cross validation and default scoring
+
+_TASK_DISPATCH = {
+    'i': (Classifier, Clf_feature_selector, StackingClassifier,
+          StratifiedKFold, 'neg_log_loss'),
+    'f': (Regressor, Reg_feature_selector, StackingRegressor,
+          KFold, 'neg_mean_squared_error')
+}
+
+
 class Optimiser():
 
     """Optimises hyper-parameters of the whole Pipeline.
@@ -56,19 +76,68 @@ class Optimiser():
 
     verbose : bool, default = True
         Verbose mode
+
+    parallelism : int, default = 1
+        Number of hyper-parameter configurations evaluated concurrently
+        by the optimiser. If 1, trials are run one after another.
+
+        If > 1, trials are distributed with hyperopt's MongoTrials (when
+        trials_uri is set) or SparkTrials (otherwise). Note that TPE
+        suggestions degrade as parallelism grows, since each new trial
+        is proposed without the results of the ones still running.
+
+    trials_uri : str or None, default = None
+        MongoDB URI of the trials database, ex: "mongo://host:port/db/jobs".
+        Only used if parallelism > 1. The experiment key is derived from the
+        data, the settings and the search space, so that an interrupted run
+        is resumed. Workers must be started separately:
+
+        hyperopt-mongo-worker --mongo=host:port/db --poll-interval=0.1 --workdir=...
+
+    cv_jobs : int, default = -1
+        Number of jobs used to compute the cross validation folds in
+        parallel. -1 means using all processors. Forced to 1 in optimise
+        when parallelism > 1 to avoid oversubscription. If cv_jobs != 1, prefer
+        setting n_jobs=1 (or nthread=1) for the estimators to test.
+
+    float32 : bool, default = True
+        If True, float features are converted once to float32 before the
+        cross validation. Set to False to keep float64 precision.
+
+    pruning_margin : float or None, default = None
+        If set, during the optimisation, the first min(cv_jobs, n_folds - 1)
+        folds of a trial are computed first, and the trial is stopped if
+        their score is lower than best - pruning_margin * |best|, where best
+        is the best mean score so far. This score is then returned (and not
+        cached). Ex: 0.1.
+        If None, all the folds are always computed.
     """
 
     def __init__(self, scoring=None,
                  n_folds=2,
                  random_state=1,
                  to_path="save",
-                 verbose=True):
+                 verbose=True,
+                 parallelism=1,
+                 trials_uri=None,
+                 cv_jobs=-1,
+                 float32=True,
+                 pruning_margin=None):
 
         self.scoring = scoring
         self.n_folds = n_folds
         self.random_state = random_state
         self.to_path = to_path
         self.verbose = verbose
+        self.parallelism = parallelism
+        self.trials_uri = trials_uri
+        self.cv_jobs = cv_jobs
+        self.float32 = float32
+        self.pruning_margin = pruning_margin
+        self.__task = None
+        self.__memory = joblib.Memory(location=self.to_path,
+                                      mmap_mode='c',
+                                      verbose=0)
 
         warnings.warn("Optimiser will save all your fitted models into directory '"
                       +str(self.to_path)+"/joblib'. Please clear it regularly.")
@@ -79,7 +148,12 @@ class Optimiser():
                 'n_folds': self.n_folds,
                 'random_state': self.random_state,
                 'to_path': self.to_path,
-                'verbose': self.verbose}
+                'verbose': self.verbose,
+                'parallelism': self.parallelism,
+                'trials_uri': self.trials_uri,
+                'cv_jobs': self.cv_jobs,
+                'float32': self.float32,
+                'pruning_margin': self.pruning_margin}
 
     def set_params(self, **params):
 
@@ -93,371 +167,654 @@ class Optimiser():
             else:
                 setattr(self, k, v)
 
+        if ("to_path" in params):
+            self.__memory = joblib.Memory(location=self.to_path,
+                                          mmap_mode='c',
+                                          verbose=0)
 
-    def evaluate(self, params, df):
+    def __prepare_task(self, df):
 
-        """Evaluates the data.
+        """Prepares the cross validation for a given dataset.
 
-
-        Evaluates the data with a given scoring function and given hyper-parameters
-        of the whole pipeline. If no parameters are set, default configuration for
-        each step is evaluated : no feature selection is applied and no meta features are
-        created.
+        Checks the task, the classes to drop (with less samples than n_folds)
+        and the scoring function. The result only depends on the dataset and
+        on the optimiser settings, so it is computed once and reused by all
+        the trials.
 
         Parameters
         ----------
-        params : dict, default = None.
-            Hyper-parameters dictionary for the whole pipeline.
-
-            - The keys must respect the following syntax : "enc__param".
-
-                - "enc" = "ne" for na encoder
-                - "enc" = "ce" for categorical encoder
-                - "enc" = "fs" for feature selector [OPTIONAL]
-                - "enc" = "stck"+str(i) to add layer n°i of meta-features [OPTIONAL]
-                - "enc" = "est" for the final estimator
-
-                - "param" : a correct associated parameter for each step. Ex: "max_depth" for "enc"="est", ...
-
-            - The values are those of the parameters. Ex: 4 for key = "est__max_depth", ...
-
-        df : dict, default = None
-            Dataset dictionary. Must contain keys and values:
-
-            - "train": pandas DataFrame for the train set.
-            - "target" : encoded pandas Serie for the target on train set (with dtype='float' for a regression or dtype='int' for a classification). Indexes should match the train set.
+        df : dict
+            Dataset dictionary with keys "train" and "target".
 
         Returns
         -------
-        float.
-            The score. The higher the better.
-            Positive for a score and negative for a loss.
-
-        Examples
-        --------
-        >>> from mlbox.optimisation import *
-        >>> from sklearn.datasets import load_boston
-        >>> #load data
-        >>> dataset = load_boston()
-        >>> #evaluating the pipeline
-        >>> opt = Optimiser()
-        >>> params = {
-        ...     "ne__numerical_strategy" : 0,
-        ...     "ce__strategy" : "label_encoding",
-        ...     "fs__threshold" : 0.1,
-        ...     "stck__base_estimators" : [Regressor(strategy="RandomForest"), Regressor(strategy="ExtraTrees")],
-        ...     "est__strategy" : "Linear"
-        ... }
-        >>> df = {"train" : pd.DataFrame(dataset.data), "target" : pd.Series(dataset.target)}
-        >>> opt.evaluate(params, df)
+        dict.
+            The estimator, feature selector and stacking classes of the task,
+            the cross validation folds, the scoring function and the train
+            set (with float32 features if float32=True) and target without the
+            dropped classes.
         """
 
-        ne = NA_encoder()
-        ce = Categorical_encoder()
+        settings = (self.scoring, self.n_folds, self.random_state, self.float32)
 
-        ##########################################
-        #    Automatically checking the task
-        ##########################################
+        if (self.__task is not None):
+            if ((self.__task["train"] is df['train'])
+                    and (self.__task["target"] is df['target'])
+                    and (self.__task["settings"] == settings)):
+                return self.__task
 
-        # TODO: a lot of code can be factorized for the different tasks
+        if (df['target'].dtype.kind not in _TASK_DISPATCH):
+            raise ValueError("Impossible to determine the task. "
+                             "Please check that your target is encoded.")
 
-        ##########################################
-        #             Classification
-        ##########################################
+        (estimator, feature_selector, stacking,
+         splitter, default_scoring) = _TASK_DISPATCH[df['target'].dtype.kind]
+
+        # Cross validation : classes with less samples than n_folds are dropped
 
-        if (df['target'].dtype == 'int'):
+        X = df['train']
+        y = df['target']
+        n_classes = None
 
-            # Cross validation
+        if (splitter is StratifiedKFold):
 
             counts = df['target'].value_counts()
             classes_to_drop = counts[counts < self.n_folds].index
-            mask_to_drop = df['target'].apply(lambda x: x in classes_to_drop)
-            indexes_to_drop = df['target'][mask_to_drop].index
             n_classes = len(counts) - len(classes_to_drop)
 
+            if (len(classes_to_drop) != 0):
+                mask_to_keep = ~_accel.isin(df['target'], classes_to_drop)
+                X = df['train'].loc[mask_to_keep]
+                y = df['target'].loc[mask_to_keep]
+
             if n_classes == 1:
                 raise ValueError("Your target has not enough classes. You can't run the optimiser")
 
-            cv = StratifiedKFold(n_splits=self.n_folds,
-                                 shuffle=True,
-                                 random_state=self.random_state)
+            # The encoders check for the default int dtype (ex: entity embedding)
 
-            # Estimator
+            if (y.dtype != 'int'):
+                y = y.astype('int')
 
-            est = Classifier()
+        # Float features are converted once instead of by each estimator
 
-            # Feature selection if specified
+        if (self.float32):
 
-            fs = None
-            if (params is not None):
-                for p in params.keys():
-                    if (p.startswith("fs__")):
-                        fs = Clf_feature_selector()
-                    else:
-                        pass
+            float_cols = X.select_dtypes('float').columns
 
-            # Stacking if specified
+            if (len(float_cols) != 0):
+                X = X.astype({col: np.float32 for col in float_cols}, copy=False)
 
-            STCK = {}
-            if (params is not None):
-                for p in params.keys():
-                    if (p.startswith("stck")):
-                        # TODO: Check if p.split("__")[1] instead?
-                        STCK[p.split("__")[0]] = StackingClassifier(verbose=False)  # noqa
-                    else:
-                        pass
+        cv = splitter(n_splits=self.n_folds,
+                      shuffle=True,
+                      random_state=self.random_state)
+        folds = list(cv.split(X, y))
 
-            # Default scoring for classification
+        # Scoring
 
-            if (self.scoring is None):
-                self.scoring = 'neg_log_loss'  # works also for multiclass pb
+        scoring = self.scoring
 
-            else:
-                if (type(self.scoring) == str):
-                    if (self.scoring not in list(SCORERS.keys())):
+        if (scoring is None):
+            scoring = default_scoring
 
-                        warnings.warn("Unknown or invalid scoring metric. "
-                                      "neg_log_loss is used instead.")
+        elif (type(scoring) == str):
 
-                        self.scoring = 'neg_log_loss'
+            if (scoring not in list(SCORERS.keys())):
 
-                    else:
+                warnings.warn("Unknown or invalid scoring metric. "
+                              + default_scoring + " is used instead.")
 
-                        # binary classification
-                        if n_classes <= 2:
-                            pass
+                scoring = default_scoring
 
-                        # multiclass classification
-                        else:
-                            warnings.warn("This is a multiclass problem. Please make sure that your scoring metric is "
-                                          "appropriate.")
+            # multiclass classification
+            elif ((n_classes is not None) and (n_classes > 2)):
 
-                            if self.scoring+"_weighted" in list(SCORERS.keys()):
+                warnings.warn("This is a multiclass problem. Please make sure that your scoring metric is "
+                              "appropriate.")
 
-                                warnings.warn("Weighted strategy for the scoring metric is used.")
-                                self.scoring = self.scoring + "_weighted"
+                if scoring+"_weighted" in list(SCORERS.keys()):
 
-                            # specific scenarios
-                            else:
-                                if self.scoring == "roc_auc":
-                                    self.scoring = make_scorer(lambda y_true, y_pred: roc_auc_score(pd.get_dummies(y_true), y_pred),  # noqa
-                                                               greater_is_better=True,
-                                                               needs_proba=True)
-                else:
-                    pass
+                    warnings.warn("Weighted strategy for the scoring metric is used.")
+                    scoring = scoring + "_weighted"
 
-        ##########################################
-        #               Regression
-        ##########################################
+                # specific scenarios
+                elif scoring == "roc_auc":
+                    lb = LabelBinarizer().fit(y)
+                    scoring = make_scorer(lambda y_true, y_pred: roc_auc_score(lb.transform(y_true), y_pred),  # noqa
+                                          greater_is_better=True,
+                                          needs_proba=True)
 
-        elif (df['target'].dtype == 'float'):
+        self.__task = {"train": df['train'],
+                       "target": df['target'],
+                       "settings": settings,
+                       "estimator": estimator,
+                       "feature_selector": feature_selector,
+                       "stacking": stacking,
+                       "folds": folds,
+                       "X": X,
+                       "y": y,
+                       "scoring": scoring}
 
-            # Cross validation
+        return self.__task
 
-            indexes_to_drop = []
-            cv = KFold(n_splits=self.n_folds,
-                       shuffle=True,
-                       random_state=self.random_state)
+    def __use_cache(self, values):
 
-            # Estimator
+        """Checks whether the transformers of the Pipeline must be cached.
 
-            est = Regressor()
+        Parameters
+        ----------
+        values : dict
+            The values each hyper-parameter of the Pipeline can take.
 
-            # Feature selection if specified
+        Returns
+        -------
+        bool.
+            True if an expensive transformer (entity embedding, supervised
+            feature selection or stacking) may be fitted.
+        """
 
-            fs = None
-            if (params is not None):
-                for p in params.keys():
-                    if (p.startswith("fs__")):
-                        fs = Reg_feature_selector()
-                    else:
-                        pass
+        if ("entity_embedding" in list(values.get("ce__strategy", []))):
+            return True
 
-            # Stacking if specified
+        if any(v != "variance" for v in values.get("fs__strategy", [])):
+            return True
 
-            STCK = {}
-            if (params is not None):
-                for p in params.keys():
-                    if (p.startswith("stck")):
-                        # TODO: Check if p.split("__")[1] instead?
-                        STCK[p.split("__")[0]] = StackingRegressor(verbose=False)
-                    else:
-                        pass
+        return any(p.startswith("stck") for p in values)
 
-            # Default scoring for regression
+    def __build_pipeline(self, steps, task, cache):
 
-            if (self.scoring is None):
-                self.scoring = "neg_mean_squared_error"
+        """Creates the Pipeline with default hyper-parameters.
 
-            else:
-                if (type(self.scoring) == str):
-                    if (self.scoring not in list(SCORERS.keys())):
+        Parameters
+        ----------
+        steps : set
+            Names of the steps to tune. "fs" and "stck"+str(i) are added to
+            the Pipeline only if they are in steps.
 
-                        warnings.warn("Unknown or invalid scoring metric. "
-                                      "neg_mean_squared_error is used instead.")
+        task : dict
+            The task, as returned by __prepare_task.
 
-                        self.scoring = 'neg_mean_squared_error'
+        cache : bool
+            Whether the transformers are cached.
 
-                    else:
-                        pass
-                else:
-                    pass
+        Returns
+        -------
+        Pipeline.
+            The (unfitted) Pipeline.
+        """
 
-        else:
-            raise ValueError("Impossible to determine the task. "
-                             "Please check that your target is encoded.")
+        pipe = [("ne", NA_encoder()), ("ce", Categorical_encoder())]
 
-        ##########################################
-        #          Creating the Pipeline
-        ##########################################
+        # Feature selection if specified
 
-        pipe = [("ne", ne), ("ce", ce)]
+        if ("fs" in steps):
+            pipe.append(("fs", task["feature_selector"]()))
 
-        # Do we need to cache transformers?
+        # Stacking if specified
 
-        cache = False
+        for stck in sorted(s for s in steps if s.startswith("stck")):
+            pipe.append((stck, task["stacking"](verbose=False)))
 
-        if (params is not None):
-            if ("ce__strategy" in params):
-                if(params["ce__strategy"] == "entity_embedding"):
-                    cache = True
-                else:
-                    pass
-            else:
-                pass
+        pipe.append(("est", task["estimator"]()))
 
-        if (fs is not None):
-            if ("fs__strategy" in params):
-                if(params["fs__strategy"] != "variance"):
-                    cache = True
-                else:
-                    pass
+        if cache:
+            pp = Pipeline(pipe, memory=self.__memory)
         else:
-            pass
+            pp = Pipeline(pipe)
 
-        if (len(STCK) != 0):
-            cache = True
-        else:
-            pass
+        return pp
 
-        # Pipeline creation
+    def __set_pipeline(self, pp, params):
 
-        if (fs is not None):
-            pipe.append(("fs", fs))
-        else:
-            pass
+        """Sets the hyper-parameters of the Pipeline (if params is not None)."""
 
-        for stck in np.sort(list(STCK)):
-            pipe.append((stck, STCK[stck]))
+        if (params is not None):
+            try:
+                pp = pp.set_params(**params)
+            except:
+                raise ValueError("Pipeline cannot be set with these parameters."
+                                 " Check the name of your stages.")
 
-        pipe.append(("est", est))
+        return pp
 
-        if cache:
-            pp = Pipeline(pipe, memory=self.to_path)
-        else:
-            pp = Pipeline(pipe)
+    def __report_pipeline(self, pp):
 
-        ##########################################
-        #          Fitting the Pipeline
-        ##########################################
+        """Displays the hyper-parameters of each step of the Pipeline."""
+
+        lines = ["",
+                 "#####################################################"
+                 " testing hyper-parameters... "
+                 "#####################################################",
+                 "",
+                 ">>> NA ENCODER :" + str(pp.named_steps["ne"].get_params()),
+                 "",
+                 ">>> CA ENCODER :" + str({'strategy': pp.named_steps["ce"].strategy})]
+
+        if ("fs" in pp.named_steps):
+            lines += ["",
+                      ">>> FEATURE SELECTOR :" + str(pp.named_steps["fs"].get_params())]
+
+        STCK = [step for name, step in pp.steps if name.startswith("stck")]
+
+        for i, stck in enumerate(STCK):
+
+            stck_params = stck.get_params().copy()
+            stck_params_display = {k: stck_params[k]
+                                   for k in stck_params.keys() if
+                                   k not in ["level_estimator",
+                                             "verbose",
+                                             "base_estimators"]}
+
+            lines += ["",
+                      ">>> STACKING LAYER n°"
+                      + str(i + 1) + " :" + str(stck_params_display)]
+
+            for j, model in enumerate(stck_params["base_estimators"]):
+                lines += ["",
+                          "    > base_estimator n°" + str(j + 1) + " :"
+                          + str(dict(list(model.get_params().items())
+                                     + list(model.get_estimator().get_params().items())))]
+
+        est = pp.named_steps["est"]
+
+        lines += ["",
+                  ">>> ESTIMATOR :" + str(
+                      dict(list(est.get_params().items())
+                           + list(est.get_estimator().get_params().items()))),
+                  ""]
+
+        print("\n".join(lines))
+
+    def __cross_validate(self, pp, task, n_jobs, threshold=None):
+
+        """Computes the mean cross validation score of the Pipeline.
+
+        Parameters
+        ----------
+        pp : Pipeline
+            The Pipeline to evaluate.
+
+        task : dict
+            The task, as returned by __prepare_task.
+
+        n_jobs : int
+            Number of jobs used to compute the folds.
+
+        threshold : float or None, default = None
+            If set, the first min(n_jobs, n_folds - 1) folds are computed
+            first. If their mean score is lower, the other folds are skipped
+            and this score is returned (pruned trial).
+
+        Returns
+        -------
+        tuple.
+            The score (the higher the better) and whether the trial is pruned.
+        """
 
         start_time = time.time()
 
-        # No params : default configuration
+        folds = task["folds"]
+        pruned = False
 
-        if (params is None):
-            set_params = True
-            print('No parameters set. Default configuration is tested')
+        try:
 
-        else:
-            try:
-                pp = pp.set_params(**params)
-                set_params = True
-            except:
-                set_params = False
-
-        if (set_params):
-
-            if (self.verbose):
-                print("")
-                print("#####################################################"
-                      " testing hyper-parameters... "
-                      "#####################################################")
-                print("")
-                print(">>> NA ENCODER :" + str(ne.get_params()))
-                print("")
-                print(">>> CA ENCODER :" + str({'strategy': ce.strategy}))
-
-                if (fs is not None):
-                    print("")
-                    print(">>> FEATURE SELECTOR :" + str(fs.get_params()))
-
-                for i, stck in enumerate(np.sort(list(STCK))):
-
-                    stck_params = STCK[stck].get_params().copy()
-                    stck_params_display = {k: stck_params[k]
-                                           for k in stck_params.keys() if
-                                           k not in ["level_estimator",
-                                                     "verbose",
-                                                     "base_estimators"]}
-
-                    print("")
-                    print(">>> STACKING LAYER n°"
-                          + str(i + 1) + " :" + str(stck_params_display))
-
-                    for j, model in enumerate(stck_params["base_estimators"]):
-                        print("")
-                        print("    > base_estimator n°" + str(j + 1) + " :"
-                              + str(dict(list(model.get_params().items())
-                                         + list(model.get_estimator().get_params().items()))))
-
-                print("")
-                print(">>> ESTIMATOR :" + str(
-                    dict(list(est.get_params().items())
-                         + list(est.get_estimator().get_params().items()))
-                ))
-                print("")
+            # Computing the mean cross validation score across the folds
 
-            try:
+            # The first round leaves at least one fold to skip
+
+            n_first = min(joblib.effective_n_jobs(n_jobs), len(folds) - 1)
+
+            if (threshold is not None) and (n_first > 0):
 
-                # Computing the mean cross validation score across the folds
                 scores = cross_val_score(estimator=pp,
-                                         X=df['train'].drop(indexes_to_drop),
-                                         y=df['target'].drop(indexes_to_drop),
-                                         scoring=self.scoring,
-                                         cv=cv)
-                score = np.mean(scores)
+                                         X=task["X"],
+                                         y=task["y"],
+                                         scoring=task["scoring"],
+                                         cv=folds[:n_first],
+                                         n_jobs=n_jobs,
+                                         pre_dispatch='2*n_jobs',
+                                         error_score='raise')
+
+                if (np.mean(scores) < threshold):
+                    pruned = True
+                else:
+                    folds = folds[n_first:]
 
-            except:
+            else:
+                scores = []
 
-                scores = [-np.inf for _ in range(self.n_folds)]
-                score = -np.inf
+            if (not pruned):
 
-        else:
-            raise ValueError("Pipeline cannot be set with these parameters."
-                             " Check the name of your stages.")
+                other_scores = cross_val_score(estimator=pp,
+                                               X=task["X"],
+                                               y=task["y"],
+                                               scoring=task["scoring"],
+                                               cv=folds,
+                                               n_jobs=n_jobs,
+                                               pre_dispatch='2*n_jobs',
+                                               error_score='raise')
+                scores = np.concatenate((scores, other_scores))
+
+            score = np.mean(scores)
+
+        # Only errors due to the hyper-parameters or to the data give a -inf
+        # score. Others (memory, interruption, ...) are raised. TypeError is
+        # kept since estimators raise it for values of the wrong type, which
+        # the search space can give (ex: a float from a "uniform" search for
+        # an integer hyper-parameter).
+
+        except (ValueError, TypeError, FloatingPointError,
+                NotFittedError, np.linalg.LinAlgError,
+                LightGBMError, tf.errors.InvalidArgumentError) as e:
 
-        if (score == -np.inf):
             warnings.warn("An error occurred while computing the cross "
-                          "validation mean score. Please check that the parameter values are correct "
+                          "validation mean score: " + str(e) + ". Please check that the parameter values are correct "
                           "and that your scoring function is valid and appropriate to the task.")
 
+            scores = [-np.inf for _ in range(self.n_folds)]
+            score = -np.inf
+
         ##########################################
         #             Reporting scores
         ##########################################
 
-        out = " ("
+        out = ", ".join(["fold " + str(i + 1) + " = " + str(s)
+                         for i, s in enumerate(scores)])
+
+        if (self.verbose):
+
+            lines = ["",
+                     "MEAN SCORE : " + str(task["scoring"]) + " = " + str(score),
+                     "VARIANCE : " + str(np.std(scores)) + " (" + out + ")"]
+
+            if (pruned):
+                lines += ["PRUNED : first folds score below " + str(threshold)]
+
+            print("\n".join(lines + ["CPU time: %s seconds" % (time.time() - start_time),
+                                     ""]))
+
+        return score, pruned
+
+    def __params_key(self, params):
+
+        """Returns the key of a configuration in the scores cache."""
+
+        return json.dumps(params, sort_keys=True, default=repr)
+
+    def __context(self, df):
+
+        """Identifies the data and the settings the scores depend on."""
+
+        return (repr((self.scoring, self.n_folds,
+                      self.random_state, self.float32))
+                + joblib.hash((df['train'], df['target'])))
+
+    def __load_scores(self, df):
+
+        """Loads the scores cache of an optimisation.
+
+        Scores are cached since TPE often suggests the same configuration
+        twice. They are also saved on disk and reused by the next runs with
+        the same data and settings, except for a callable scoring (its repr
+        does not identify it).
+
+        Parameters
+        ----------
+        df : dict
+            Dataset dictionary with keys "train" and "target".
+
+        Returns
+        -------
+        dict.
+            The scores by configuration key ("scores"), the scores saved for
+            the data and settings ("saved", None if they are not saved), the
+            content of the cache file ("file") and its path ("path").
+        """
 
-        for i, s in enumerate(scores[:-1]):
-            out = out + "fold " + str(i + 1) + " = " + str(s) + ", "
+        scores = {"scores": dict(),
+                  "saved": None,
+                  "file": None,
+                  "path": os.path.join(self.to_path, "eval_cache.joblib")}
+
+        if (self.scoring is None) or (type(self.scoring) == str):
+
+            context = self.__context(df)
+
+            if (os.path.exists(scores["path"])):
+                scores["file"] = joblib.load(scores["path"])
+            else:
+                scores["file"] = dict()
+
+            scores["saved"] = scores["file"].setdefault(context, dict())
+            scores["scores"].update(scores["saved"])
+
+        return scores
+
+    def __save_score(self, scores, params, score):
+
+        """Stores the score of a configuration in the scores cache.
+
+        The score is saved on disk only if the parameters are JSON values
+        (ex: not estimators), since only their key is then stable.
+        """
+
+        key = self.__params_key(params)
+        scores["scores"][key] = score
+
+        if (scores["saved"] is not None):
+            try:
+                json.dumps(params)
+                scores["saved"][key] = score
+            except TypeError:
+                pass
+
+    def __dump_scores(self, scores):
+
+        """Saves the scores cache on disk (if the scores are saved)."""
+
+        if (scores["file"] is not None):
+            os.makedirs(self.to_path, exist_ok=True)
+            joblib.dump(scores["file"], scores["path"])
+
+    def __grid_size(self, space):
+
+        """Returns the number of points of the space (inf if not discrete)."""
+
+        grid_size = 1
+
+        for p in space.keys():
+            if (space[p].get("search", "choice") == "choice"):
+                grid_size *= len(space[p]["space"])
+            else:
+                grid_size = np.inf
+
+        return grid_size
+
+    def __grid_search(self, space, evaluate_trial, scores):
+
+        """Evaluates all the points of a discrete space.
+
+        Points are evaluated in parallel with cv_jobs jobs : folds are
+        sequential and no trial is pruned.
+
+        Parameters
+        ----------
+        space : dict
+            The search space, as given to optimise.
+
+        evaluate_trial : callable
+            Returns the score of a configuration and whether it is pruned.
+
+        scores : dict
+            The scores cache, as returned by __load_scores.
+
+        Returns
+        -------
+        dict.
+            The best configuration.
+        """
+
+        grid = [dict(zip(space.keys(), values))
+                for values in itertools.product(*[space[p]["space"]
+                                                  for p in space.keys()])]
+        keys = [self.__params_key(params) for params in grid]
+        to_evaluate = [i for i, key in enumerate(keys)
+                       if key not in scores["scores"]]
+
+        results = joblib.Parallel(n_jobs=self.cv_jobs)(
+            joblib.delayed(evaluate_trial)(grid[i], 1)
+            for i in to_evaluate)
+
+        for i, (score, _) in zip(to_evaluate, results):
+            self.__save_score(scores, grid[i], score)
+
+        return grid[int(np.argmax([scores["scores"][key] for key in keys]))]
+
+    def __tpe_search(self, hyper_space, space, objective, max_evals, exp_key):
+
+        """Optimises the objective with TPE.
+
+        Parameters
+        ----------
+        hyper_space : dict
+            The hyperopt search space.
+
+        space : dict
+            The search space, as given to optimise.
+
+        objective : callable
+            The loss of a configuration.
+
+        max_evals : int
+            Number of iterations.
+
+        exp_key : str
+            Experiment key of the trials in the MongoDB database.
+
+        Returns
+        -------
+        dict.
+            The best configuration.
+        """
+
+        # Trials database : distributed if parallelism is set
+
+        if (self.parallelism > 1):
+
+            warnings.warn("Trials are run in parallel. TPE suggestions "
+                          "may be less accurate than in sequential mode.")
+
+            if (self.cv_jobs != 1):
+                warnings.warn("Trials are run in parallel. cv_jobs is "
+                              "set to 1 for the cross validation.")
+
+            if (self.trials_uri is not None):
+                from hyperopt.mongoexp import MongoTrials
+                trials = MongoTrials(self.trials_uri, exp_key=exp_key)
+            else:
+                from hyperopt import SparkTrials
+                trials = SparkTrials(parallelism=self.parallelism)
+
+        else:
+            trials = None
+
+        best_params = fmin(objective,
+                           space=hyper_space,
+                           algo=tpe.suggest,
+                           max_evals=max_evals,
+                           trials=trials,
+                           rstate=np.random.RandomState(self.random_state))
+
+        # Indexes are converted for 'choice' parameters
+
+        for p, v in best_params.items():
+            if ("search" in space[p]):
+                if (space[p]["search"] == "choice"):
+                    best_params[p] = space[p]["space"][v]
+                else:
+                    pass
+            else:
+                best_params[p] = space[p]["space"][v]
+
+        return best_params
+
+    def evaluate(self, params, df):
+
+        """Evaluates the data.
+
+
+        Evaluates the data with a given scoring function and given hyper-parameters
+        of the whole pipeline. If no parameters are set, default configuration for
+        each step is evaluated : no feature selection is applied and no meta features are
+        created.
+
+        Parameters
+        ----------
+        params : dict, default = None.
+            Hyper-parameters dictionary for the whole pipeline.
+
+            - The keys must respect the following syntax : "enc__param".
+
+                - "enc" = "ne" for na encoder
+                - "enc" = "ce" for categorical encoder
+                - "enc" = "fs" for feature selector [OPTIONAL]
+                - "enc" = "stck"+str(i) to add layer n°i of meta-features [OPTIONAL]
+                - "enc" = "est" for the final estimator
+
+                - "param" : a correct associated parameter for each step. Ex: "max_depth" for "enc"="est", ...
+
+            - The values are those of the parameters. Ex: 4 for key = "est__max_depth", ...
+
+        df : dict, default = None
+            Dataset dictionary. Must contain keys and values:
+
+            - "train": pandas DataFrame for the train set.
+            - "target" : encoded pandas Serie for the target on train set (with dtype='float' for a regression or dtype='int' for a classification). Indexes should match the train set.
+
+        Returns
+        -------
+        float.
+            The score. The higher the better.
+            Positive for a score and negative for a loss.
+
+        Examples
+        --------
+        >>> from mlbox.optimisation import *
+        >>> from sklearn.datasets import load_boston
+        >>> #load data
+        >>> dataset = load_boston()
+        >>> #evaluating the pipeline
+        >>> opt = Optimiser()
+        >>> params = {
+        ...     "ne__numerical_strategy" : 0,
+        ...     "ce__strategy" : "label_encoding",
+        ...     "fs__threshold" : 0.1,
+        ...     "stck__base_estimators" : [Regressor(strategy="RandomForest"), Regressor(strategy="ExtraTrees")],
+        ...     "est__strategy" : "Linear"
+        ... }
+        >>> df = {"train" : pd.DataFrame(dataset.data), "target" : pd.Series(dataset.target)}
+        >>> opt.evaluate(params, df)
+        """
+
+        task = self.__prepare_task(df)
+
+        # No params : default configuration
+
+        if (params is None):
+            print('No parameters set. Default configuration is tested')
+            values = dict()
+
+        else:
+            values = {p: [v] for p, v in params.items()}
+
+        pp = self.__build_pipeline(set(p.split("__", 1)[0] for p in values),
+                                   task,
+                                   self.__use_cache(values))
+        pp = self.__set_pipeline(pp, params)
 
         if (self.verbose):
-            print("")
-            print("MEAN SCORE : " + str(self.scoring) + " = " + str(score))
-            print("VARIANCE : " + str(np.std(scores))
-                  + out + "fold " + str(i + 2) + " = " + str(scores[-1]) + ")")
-            print("CPU time: %s seconds" % (time.time() - start_time))
-            print("")
+            self.__report_pipeline(pp)
+
+        score, _ = self.__cross_validate(pp, task, self.cv_jobs)
 
         return score
 
@@ -468,6 +825,11 @@ class Optimiser():
         Optimises hyper-parameters of the whole Pipeline with a given scoring
         function. Algorithm used to optimize : Tree Parzen Estimator.
 
+        If all the hyper-parameters use the "choice" search and the grid has
+        at most max_evals points, the whole grid is evaluated instead, with
+        cv_jobs local jobs. This is not done if parallelism > 1 : TPE then
+        runs the trials on the configured MongoDB or Spark workers.
+
         IMPORTANT : Try to avoid dependent parameters and to set one feature
         selection strategy and one estimator strategy at a time.
 
@@ -522,8 +884,6 @@ class Optimiser():
         >>> best = opt.optimise(space, df, 3)
         """
 
-        hyperopt_objective = lambda params: -self.evaluate(params, df)
-
         # Creating a correct space for hyperopt
 
         if (space is None):
@@ -569,29 +929,103 @@ class Optimiser():
                         else:
                             hyper_space[p] = hp.choice(p, space[p]["space"])
 
-                best_params = fmin(hyperopt_objective,
-                                   space=hyper_space,
-                                   algo=tpe.suggest,
-                                   max_evals=max_evals)
+                # Task and cross validation are prepared once for all the trials
 
-                # Displaying best_params
+                task = self.__prepare_task(df)
+
+                # Evaluation specialised for the search space : the structure
+                # of the Pipeline, the cache and the number of jobs are the
+                # same for all the trials.
+
+                steps = set(p.split("__", 1)[0] for p in space.keys())
+                cache = self.__use_cache({p: space[p]["space"]
+                                          for p in space.keys()})
+
+                # Folds are computed sequentially if trials are already parallel
+
+                if (self.parallelism > 1):
+                    n_jobs = 1
+                else:
+                    n_jobs = self.cv_jobs
+
+                # The Pipeline is built once and cloned for each trial
+
+                template = self.__build_pipeline(steps, task, cache)
+
+                def evaluate_trial(params, n_jobs, threshold=None):
+
+                    # clone() deep-copies the memory : the shared one is set back
+
+                    pp = clone(template)
+                    pp.memory = template.memory
+                    pp = self.__set_pipeline(pp, params)
+
+                    if (self.verbose):
+                        self.__report_pipeline(pp)
+
+                    return self.__cross_validate(pp, task, n_jobs, threshold)
+
+                scores = self.__load_scores(df)
+
+                # Unpromising trials are pruned after their first folds
+
+                best_score = -np.inf
+
+                def hyperopt_objective(params):
+
+                    nonlocal best_score
+
+                    key = self.__params_key(params)
+
+                    if (key in scores["scores"]):
+                        score = scores["scores"][key]
 
-                for p, v in best_params.items():
-                    if ("search" in space[p]):
-                        if (space[p]["search"] == "choice"):
-                            best_params[p] = space[p]["space"][v]
-                        else:
-                            pass
                     else:
-                        best_params[p] = space[p]["space"][v]
+
+                        if (self.pruning_margin is not None) and (best_score > -np.inf):
+                            threshold = best_score - self.pruning_margin * abs(best_score)
+                        else:
+                            threshold = None
+
+                        score, pruned = evaluate_trial(params, n_jobs, threshold)
+
+                        # A pruned score is not a full cross validation score
+
+                        if (not pruned):
+                            self.__save_score(scores, params, score)
+
+                    best_score = max(best_score, score)
+
+                    return -score
+
+                # Small discrete space : the whole grid is evaluated instead,
+                # with local jobs. Distributed trials (parallelism > 1) always
+                # use TPE with the configured workers.
+
+                if (self.parallelism <= 1) and (self.__grid_size(space) <= max_evals):
+                    best_params = self.__grid_search(space, evaluate_trial, scores)
+
+                else:
+                    # Runs with the same data, settings and space share their
+                    # trials database : an interrupted run is resumed
+
+                    exp_key = "mlbox_" + joblib.hash((self.__context(df),
+                                                      self.__params_key(space)))
+
+                    best_params = self.__tpe_search(hyper_space, space,
+                                                    hyperopt_objective,
+                                                    max_evals, exp_key)
+
+                self.__dump_scores(scores)
 
                 if (self.verbose):
-                    print("")
-                    print("")
-                    print("~" * 137)
-                    print("~" * 57 + " BEST HYPER-PARAMETERS " + "~" * 57)
-                    print("~" * 137)
-                    print("")
-                    print(best_params)
+                    print("\n".join([
+                        "",
+                        "",
+                        "~" * 137,
+                        "~" * 57 + " BEST HYPER-PARAMETERS " + "~" * 57,
+                        "~" * 137,
+                        "",
+                        str(best_params)]))
 
                 return best_params
@@ -0,0 +1,29 @@
+# !/usr/bin/env python
+# coding: utf-8
+# Author: Axel ARONIO DE ROMBLAY <axelderomblay@gmail.com>
+# License: BSD 3 clause
+"""Test mlbox._accel module."""
+import numpy as np
+import pandas as pd
+
+from mlbox._accel import isin, _isin_int64
+
+
+def test_isin():
+    """Test isin function."""
+    serie = pd.Series([0, 3, 1, 3, 2, 5], dtype="int64")
+    mask = isin(serie, pd.Index([3, 5]))
+    assert type(mask) == np.ndarray
+    assert mask.tolist() == [False, True, False, True, False, True]
+    assert not isin(serie, []).any()
+
+
+def test_isin_int64():
+    """Test _isin_int64 kernel (compiled if numba is installed)."""
+    arr = np.array([0, 3, 1, 3, 2, 5], dtype=np.int64)
+    mask = _isin_int64(arr, np.array([3, 5], dtype=np.int64))
+    assert mask.dtype == np.bool_
+    assert mask.tolist() == [False, True, False, True, False, True]
+    assert not _isin_int64(arr, np.array([], dtype=np.int64)).any()
+    assert _isin_int64(np.array([], dtype=np.int64),
+                       np.array([3], dtype=np.int64)).shape == (0, )
@@ -4,9 +4,13 @@
 # Author: Henri GERARD <hgerard.pro@gmail.com>
 # License: BSD 3 clause
 """Test mlbox.optimisation.optimiser module."""
+import os
 import pytest
 import numpy as np
+import hyperopt
+import joblib
 
+import mlbox.optimisation.optimiser as optimiser_module
 from mlbox.optimisation.optimiser import Optimiser
 from mlbox.preprocessing.drift_thresholder import Drift_thresholder
 from mlbox.preprocessing.reader import Reader
@@ -23,6 +27,11 @@ def test_init_optimiser():
     assert optimiser.random_state == 1
     assert optimiser.to_path == "save"
     assert optimiser.verbose
+    assert optimiser.parallelism == 1
+    assert optimiser.trials_uri is None
+    assert optimiser.cv_jobs == -1
+    assert optimiser.float32
+    assert optimiser.pruning_margin is None
 
 
 def test_get_params_optimiser():
@@ -34,7 +43,12 @@ def test_get_params_optimiser():
             'n_folds': 2,
             'random_state': 1,
             'to_path': "save",
-            'verbose': True}
+            'verbose': True,
+            'parallelism': 1,
+            'trials_uri': None,
+            'cv_jobs': -1,
+            'float32': True,
+            'pruning_margin': None}
     assert optimiser.get_params() == dict
 
 
@@ -53,6 +67,8 @@ def test_set_params_optimiser():
     assert optimiser.to_path == "name"
     optimiser.set_params(verbose=False)
     assert not optimiser.verbose
+    optimiser.set_params(cv_jobs=1)
+    assert optimiser.cv_jobs == 1
     with pytest.warns(UserWarning) as record:
         optimiser.set_params(wrong_key=3)
     assert len(record) == 1
@@ -84,7 +100,93 @@ def test_evaluate_classification_optimiser():
     assert len(record) == 1
     with pytest.warns(UserWarning) as record:
         score = opt.evaluate(None, dict)
-    assert opt.scoring == "neg_log_loss"
+    assert opt.scoring == "wrong_scoring"
+    assert -np.Inf < score <= 0.
+
+
+def test_evaluate_multiclass_optimiser():
+    """Test evaluate method of Optimiser class for multiclass roc_auc."""
+    reader = Reader(sep=",")
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    df = {"train": dict["train"].drop("Pclass", axis=1),
+          "target": dict["train"]["Pclass"].astype(int)}
+    assert df["target"].nunique() == 3
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(scoring="roc_auc", n_folds=3)
+    assert len(record) == 1
+    with pytest.warns(UserWarning) as record:
+        score = opt.evaluate(None, df)
+    assert any("multiclass" in str(w.message) for w in record)
+    assert opt.scoring == "roc_auc"
+    assert 0. <= score <= 1.
+
+
+def test_prepare_task_reuse():
+    """Test when the prepared task of Optimiser class is reused."""
+    reader = Reader(sep=",")
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(n_folds=3)
+    assert len(record) == 1
+    task = opt._Optimiser__prepare_task(dict)
+    assert task["scoring"] == "neg_log_loss"
+    assert opt._Optimiser__prepare_task(dict) is task
+
+    opt.set_params(scoring="accuracy")
+    task = opt._Optimiser__prepare_task(dict)
+    assert task["scoring"] == "accuracy"
+    assert opt._Optimiser__prepare_task(dict) is task
+
+    df = {"train": dict["train"].copy(), "target": dict["target"]}
+    assert opt._Optimiser__prepare_task(df) is not task
+
+    df = {"train": dict["train"].drop("Pclass", axis=1),
+          "target": dict["train"]["Pclass"].astype(int)}
+    opt.set_params(scoring="f1")
+    with pytest.warns(UserWarning):
+        task = opt._Optimiser__prepare_task(df)
+    assert task["scoring"] == "f1_weighted"
+    assert opt.scoring == "f1"
+
+
+def test_prepare_task_float32():
+    """Test the conversion of the float features of Optimiser class."""
+    reader = Reader(sep=",")
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    dtypes = dict["train"].dtypes
+    float_cols = dtypes[dtypes == np.float64].index
+    other_cols = dtypes[dtypes != np.float64].index
+    assert len(float_cols) > 0
+    assert len(other_cols) > 0
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(n_folds=3)
+    assert len(record) == 1
+    X = opt._Optimiser__prepare_task(dict)["X"]
+    assert (X[float_cols].dtypes == np.float32).all()
+    assert (X[other_cols].dtypes == dtypes[other_cols]).all()
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(n_folds=3, float32=False)
+    assert len(record) == 1
+    X = opt._Optimiser__prepare_task(dict)["X"]
+    assert (X.dtypes == dtypes).all()
 
 
 def test_evaluate_regression_optimiser():
@@ -122,7 +224,7 @@ def test_evaluate_regression_optimiser():
     assert -np.Inf <= score
 
 
-def test_evaluate_and_optimise_classification():
+def test_evaluate_and_optimise_classification(tmp_path):
     """Test evaluate_and_optimise method of Optimiser class."""
     reader = Reader(sep=",")
 
@@ -141,7 +243,7 @@ def test_evaluate_and_optimise_classification():
         score = opt.evaluate(None, dict_error)
 
     with pytest.warns(UserWarning) as record:
-        opt = Optimiser(scoring='accuracy', n_folds=3)
+        opt = Optimiser(scoring='accuracy', n_folds=3, to_path=str(tmp_path))
     assert len(record) == 1
     score = opt.evaluate(None, dict)
     assert 0. <= score <= 1.
@@ -158,3 +260,163 @@ def test_evaluate_and_optimise_classification():
 
     best = opt.optimise(space, dict, 1)
     assert type(best) == type(dict)
+
+    space = {'ce__strategy': {"search": "choice",
+                              "space": ["label_encoding", "dummification"]},
+             'est__max_depth': {"search": "choice",
+                                "space": [3, 5]}
+             }
+
+    best = opt.optimise(space, dict, 4)
+    assert best["ce__strategy"] in ["label_encoding", "dummification"]
+    assert best["est__max_depth"] in [3, 5]
+
+
+def test_optimise_scores_cache(tmp_path, monkeypatch):
+    """Test that optimise does not refit an already evaluated configuration."""
+    reader = Reader(sep=",")
+
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(scoring='accuracy', n_folds=3, to_path=str(tmp_path),
+                        cv_jobs=1, verbose=False)
+    assert len(record) == 1
+
+    space = {'est__max_depth': {"search": "choice", "space": [3, 5]}}
+
+    best = opt.optimise(space, dict, 2)
+    assert os.path.exists(os.path.join(str(tmp_path), "eval_cache.joblib"))
+
+    def refit(*args, **kwargs):
+        raise AssertionError("An evaluated configuration is refitted")
+
+    monkeypatch.setattr(Optimiser, "_Optimiser__cross_validate", refit)
+    assert opt.optimise(space, dict, 2) == best
+
+
+def test_optimise_parallelism(tmp_path, monkeypatch):
+    """Test that optimise distributes the trials if parallelism > 1."""
+    reader = Reader(sep=",")
+
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    calls = {"n_jobs": []}
+
+    class SparkTrials():
+        def __init__(self, parallelism):
+            calls["parallelism"] = parallelism
+
+    def fmin(fn, space, algo, max_evals, trials, rstate):
+        calls["trials"] = trials
+        fn({'est__max_depth': 3})
+        return {'est__max_depth': 0}
+
+    def cross_val_score(estimator, X, y, scoring, cv, n_jobs, **kwargs):
+        calls["n_jobs"].append(n_jobs)
+        return np.zeros(len(cv))
+
+    monkeypatch.setattr(hyperopt, "SparkTrials", SparkTrials)
+    monkeypatch.setattr(optimiser_module, "fmin", fmin)
+    monkeypatch.setattr(optimiser_module, "cross_val_score", cross_val_score)
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(n_folds=3, to_path=str(tmp_path), verbose=False,
+                        parallelism=4)
+    assert len(record) == 1
+
+    space = {'est__max_depth': {"search": "choice", "space": [3, 5]}}
+
+    with pytest.warns(UserWarning) as record:
+        best = opt.optimise(space, dict, 2)
+    messages = [str(w.message) for w in record]
+    assert any("TPE suggestions" in m for m in messages)
+    assert any("cv_jobs is set to 1" in m for m in messages)
+
+    assert best == {'est__max_depth': 3}
+    assert calls["parallelism"] == 4
+    assert isinstance(calls["trials"], SparkTrials)
+    assert calls["n_jobs"] == [1]
+
+
+def test_optimise_pruning(tmp_path, monkeypatch):
+    """Test that optimise prunes the unpromising trials without caching them."""
+    reader = Reader(sep=",")
+
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    n_folds = {3: [], 5: []}
+
+    def fmin(fn, space, algo, max_evals, trials, rstate):
+        assert fn({'est__max_depth': 3}) == 0.5
+        assert fn({'est__max_depth': 5}) == 10.
+        assert fn({'est__max_depth': 5}) == 10.
+        return {'est__max_depth': 0}
+
+    def cross_val_score(estimator, X, y, scoring, cv, **kwargs):
+        max_depth = estimator.named_steps["est"].get_params()["max_depth"]
+        n_folds[max_depth].append(len(cv))
+        if (max_depth == 3):
+            return -0.5 * np.ones(len(cv))
+        else:
+            return -10. * np.ones(len(cv))
+
+    monkeypatch.setattr(optimiser_module, "fmin", fmin)
+    monkeypatch.setattr(optimiser_module, "cross_val_score", cross_val_score)
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(n_folds=3, to_path=str(tmp_path), verbose=False,
+                        cv_jobs=1, pruning_margin=0.5)
+    assert len(record) == 1
+
+    space = {'est__max_depth': {"search": "choice", "space": [3, 5]}}
+
+    assert opt.optimise(space, dict, 1) == {'est__max_depth': 3}
+
+    # The bad trial stops after one fold and is evaluated again
+    assert n_folds == {3: [3], 5: [1, 1]}
+
+    eval_cache = joblib.load(os.path.join(str(tmp_path), "eval_cache.joblib"))
+    saved_scores = list(eval_cache.values())[0]
+    assert '{"est__max_depth": 3}' in saved_scores
+    assert '{"est__max_depth": 5}' not in saved_scores
+
+
+def test_evaluate_errors():
+    """Test which errors of evaluate give a -inf score."""
+    reader = Reader(sep=",")
+    dict = reader.train_test_split(Lpath=["data_for_tests/train.csv",
+                                          "data_for_tests/test.csv"],
+                                   target_name="Survived")
+    drift_thresholder = Drift_thresholder()
+    drift_thresholder = drift_thresholder.fit_transform(dict)
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(n_folds=3, cv_jobs=1)
+    assert len(record) == 1
+    with pytest.warns(UserWarning) as record:
+        score = opt.evaluate({"est__num_leaves": 1}, dict)
+    assert any("An error occurred" in str(w.message) for w in record)
+    assert score == -np.inf
+
+    def wrong_scoring(y_true, y_pred):
+        raise RuntimeError("wrong scoring")
+
+    with pytest.warns(UserWarning) as record:
+        opt = Optimiser(scoring=make_scorer(wrong_scoring), n_folds=3,
+                        cv_jobs=1)
+    assert len(record) == 1
+    with pytest.raises(RuntimeError):
+        opt.evaluate(None, dict)